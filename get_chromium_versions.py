@@ -4,11 +4,85 @@
 # API (http://versionhistory.googleapis.com/) and output the version numbers.
 # We will then then tag
 
-import argparse, datetime, json, urllib.request
+import argparse, concurrent.futures, datetime, json, urllib.request
+
+try:
+    # Optional: lets version lookups stop reading the release history at the first match.
+    import ijson
+except ImportError:
+    ijson = None
 
 channels = ["stable", "beta", "dev"]
 
 
+def fetchReleases(url: str):
+    """
+    Fetches and decodes a list of releases from the Chrome version data API.
+
+    Args:
+        url (str): The URL of the releases to fetch.
+
+    Returns:
+        dict: The decoded JSON response, or None if the request failed.
+
+    Raises:
+        JSONDecodeError: If the response data is not valid JSON.
+    """
+    try:
+        response = urllib.request.urlopen(url)
+        return json.loads(response.read())
+    except urllib.error.URLError as e:
+        printFetchError(url, e)
+        return None
+
+
+def printFetchError(url: str, e: urllib.error.URLError):
+    """
+    Prints a description of a failed request to the Chrome version data API.
+
+    Args:
+        url (str): The URL that was requested.
+        e (URLError): The error raised by the request.
+    """
+    if isinstance(e, urllib.error.HTTPError):
+        if e.code == 404:
+            print(f"Error: URL not found (404) - {url}")
+        else:
+            print(f"HTTP error occurred: {e}")
+    else:
+        print(f"Failed to reach the server: {e.reason}")
+
+
+def findRelease(url: str, version: str):
+    """
+    Looks up a specific version in a list of releases from the Chrome version data API.
+
+    If ijson is available the response is parsed as it is downloaded, and reading stops at the
+    matching release; otherwise the whole response is decoded first.
+
+    Args:
+        url (str): The URL of the releases to search.
+        version (str): The version to look for (e.g., '130.0.6723.116').
+
+    Returns:
+        dict: The matching release, or None if the version is not in the list.
+
+    Raises:
+        URLError: If there is an issue with the URL or network connection.
+        JSONDecodeError: If the response data is not valid JSON.
+        KeyError: If the expected keys are not found in the response data.
+    """
+    with urllib.request.urlopen(url) as response:
+        if ijson is not None:
+            releases = ijson.items(response, "releases.item")
+        else:
+            releases = json.loads(response.read())["releases"]
+        for release in releases:
+            if release["version"] == version:
+                return release
+    return None
+
+
 def getChromeVersionData(base_url: str, os: str, channel: str) -> tuple[str, str, str]:
     """
     Fetches the latest Chrome version data for a given operating system and channel.
@@ -32,17 +106,8 @@ def getChromeVersionData(base_url: str, os: str, channel: str) -> tuple[str, str
         url = base_url + "/"
     # Only fetch the latest release; remove the filter to get all releases
     url += f"{os}/channels/{channel}/versions/all/releases?filter=endtime=1970-01-01T00:00:00Z"
-    try:
-        response = urllib.request.urlopen(url)
-        data = json.loads(response.read())
-    except urllib.error.HTTPError as e:
-        if e.code == 404:
-            print(f"Error: URL not found (404) - {url}")
-        else:
-            print(f"HTTP error occurred: {e}")
-        return None
-    except urllib.error.URLError as e:
-        print(f"Failed to reach the server: {e.reason}")
+    data = fetchReleases(url)
+    if data is None:
         return None
 
     return data["releases"][0]["version"], data["releases"][0]["serving"]["startTime"]
@@ -67,25 +132,23 @@ def getSpecificChromeVersionData(base_url: str, os: str, version: str) -> tuple[
         JSONDecodeError: If the response data is not valid JSON.
         KeyError: If the expected keys are not found in the response data.
     """
+    urls = []
     for channel in channels:
         if not base_url.endswith("/"):
             url = base_url + "/"
         url += f"{os}/channels/{channel}/versions/all/releases"
-        try:
-            response = urllib.request.urlopen(url)
-            data = json.loads(response.read())
-        except urllib.error.HTTPError as e:
-            if e.code == 404:
-                print(f"Error: URL not found (404) - {url}")
-            else:
-                print(f"HTTP error occurred: {e}")
-            return None
-        except urllib.error.URLError as e:
-            print(f"Failed to reach the server: {e.reason}")
-            return None
-
-        for release in data["releases"]:
-            if release["version"] == version:
+        urls.append(url)
+
+    # Search every channel at once; the results are still checked in channel order.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(channels)) as executor:
+        futures = [executor.submit(findRelease, url, version) for url in urls]
+        for channel, url, future in zip(channels, urls, futures):
+            try:
+                release = future.result()
+            except urllib.error.URLError as e:
+                printFetchError(url, e)
+                return None
+            if release is not None:
                 return release["version"], release["serving"]["startTime"], channel
 
     raise Exception(f"Version {version} not found.")
@@ -124,25 +187,29 @@ def main():
                                                                 version=args.version)
         versions.append((_ver, _date, _channel))
     else:
-        for channel in channels:
-            _ver, _date = getChromeVersionData(base_url="https://versionhistory.googleapis.com/v1/chrome/platforms",
-                                                os="linux",
-                                                channel=channel)
-            versions.append((_ver, _date, channel))
+        # The channels are independent requests; overlap their round-trips.
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(channels)) as executor:
+            results = executor.map(lambda channel: getChromeVersionData(
+                base_url="https://versionhistory.googleapis.com/v1/chrome/platforms",
+                os="linux",
+                channel=channel), channels)
+            for channel, (_ver, _date) in zip(channels, results):
+                versions.append((_ver, _date, channel))
 
     if args.version is not None:
-        datestring = datetime.datetime.strptime(versions[0][1], "%Y-%m-%dT%H:%M:%S.%fZ")
+        datestring = datetime.datetime.fromisoformat(versions[0][1].replace("Z", "+00:00"))
         datestring = datestring.strftime("%B %d, %Y at %I:%M UTC")
         print(f"Chromium {versions[0][0]}: {versions[0][2]} ({datestring})")
     else:
-        for chromium in versions:
-            datestring = datetime.datetime.strptime(chromium[1], "%Y-%m-%dT%H:%M:%S.%fZ")
-            if datestring > datetime.datetime.now() - datetime.timedelta(hours=args.hours):
+        cutoff = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(hours=args.hours)
+        for _ver, _date, _channel in versions:
+            released = datetime.datetime.fromisoformat(_date.replace("Z", "+00:00"))
+            if released > cutoff:
                 if args.verbose:
-                    datestring = datestring.strftime("%B %d, %Y at %I:%M UTC")
-                    print(f"Chromium {chromium[2]}: {chromium[0]} ({datestring})")
+                    datestring = released.strftime("%B %d, %Y at %I:%M UTC")
+                    print(f"Chromium {_channel}: {_ver} ({datestring})")
                 else:
-                    print(chromium[0])
+                    print(_ver)
 
 
 if __name__ == "__main__":